@@ -12,24 +12,39 @@ RAG Knowledge Base Manager v3.1
 - [NEW] Выборочная индексация (Range selection)
 """
 
-import hashlib
+import asyncio
+import codecs
+import io
+import logging
+import mmap
 import os
+import pickle
 import sys
 import re
+import zipfile
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, partial
 from pathlib import Path
-from dataclasses import dataclass
-from typing import List, Dict, Any, Optional, Tuple
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
 
 # Библиотеки
 import chromadb
+import numpy as np
 import pypdf
 from colorama import init, Fore, Style
-from docx import Document
-from openai import OpenAI
+from lxml import etree
+from openai import APIStatusError, AsyncOpenAI, OpenAI
 from tqdm import tqdm
+import xxhash
 
 # Инициализация цветов консоли
 init(autoreset=True)
+# Предупреждения pypdf о битых файлах из процессов пула ломали бы полосу прогресса;
+# сбой чтения и так выводится строкой [READ ERROR]
+logging.getLogger("pypdf").setLevel(logging.ERROR)
 
 # --- КОНФИГУРАЦИЯ ---
 @dataclass
@@ -48,49 +63,188 @@ class Config:
     # Параметры
     CHUNK_SIZE: int = 1000
     CHUNK_OVERLAP: int = 200
-    BATCH_SIZE: int = 50
+    # Потолок фрагмента в токенах (чтобы не упираться в контекст модели эмбеддингов);
+    # 0 - резать только по символам
+    CHUNK_MAX_TOKENS: int = int(os.getenv("CHUNK_MAX_TOKENS", "512"))
+    # Максимум текстов в одном запросе эмбеддингов
+    BATCH_SIZE: int = int(os.getenv("LM_EMBED_BATCH", "256"))
+    # Бюджет токенов на запрос (оценка ~4 символа на токен) - под контекст модели 8192
+    EMBED_MAX_TOKENS: int = int(os.getenv("LM_EMBED_MAX_TOKENS", "8000"))
+    # Размер пакета записи в ChromaDB - не связан с размером запроса к LM Studio
+    DB_WRITE_BATCH: int = 4096
+    # Сколько пакетов эмбеддингов держать "в полёте" одновременно
+    EMBED_CONCURRENCY: int = int(os.getenv("LM_EMBED_CONCURRENCY", "6"))
+    # Повторы запроса эмбеддингов при обрыве связи, таймауте, 429 и 5xx (с экспоненциальной паузой)
+    EMBED_RETRIES: int = int(os.getenv("LM_EMBED_RETRIES", "5"))
+    # Сколько векторов помнить между запусками (кэш по содержимому фрагмента); 0 - выключить
+    EMBED_CACHE_SIZE: int = int(os.getenv("LM_EMBED_CACHE_SIZE", "20000"))
 
 config = Config()
 
 # --- ЛОГИКА ОБРАБОТКИ ТЕКСТА ---
 
+# Расширения, которые читаются как обычный текст
+TEXT_EXTS = frozenset({".txt", ".md", ".py", ".json", ".xml", ".html", ".java", ".kt", ".cpp"})
+# Все форматы, из которых извлекается текст; прочие файлы даже не хэшируются
+SUPPORTED_EXTS = TEXT_EXTS | {".pdf", ".docx"}
+# Разделители для нарезки в порядке приоритета; "" - жёсткий разрез по длине
+SEPARATORS = ("\n\n", "\n", ". ", " ", "")
+# Файлы крупнее хэшируются блоками, а не через mmap
+MMAP_HASH_LIMIT = 1 << 30
+# Текстовые файлы от этого размера читаются окнами TEXT_BLOCK из mmap
+MMAP_TEXT_MIN = 16 << 20
+TEXT_BLOCK = 4 << 20
+
+# Ответы LM Studio, которые повтор не исправит (например, фрагмент длиннее контекста модели):
+# такой пакет делится, чтобы отбраковать только сами отклонённые тексты
+REJECT_STATUSES = frozenset({400, 413, 422})
+
+# Теги WordprocessingML, из которых собирается текст абзаца DOCX
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+DOCX_TEXT_TAGS = {_W + "t": None, _W + "tab": "\t", _W + "br": "\n", _W + "cr": "\n"}
+
+@lru_cache(maxsize=1)
+def get_tokenizer():
+    """
+    Токенизатор для оценки длины фрагментов (cl100k_base - приближение к токенизатору
+    модели эмбеддингов). Загружается один раз на процесс. Если tiktoken не установлен
+    или словарь недоступен (офлайн без кэша), возвращает None - режем только по символам.
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"{Fore.YELLOW}[WARN] Токенизатор недоступен, лимит CHUNK_MAX_TOKENS отключён: {e}")
+        return None
+
+@lru_cache(maxsize=1)
+def get_pymupdf():
+    """
+    PyMuPDF (MuPDF на C) - извлекает текст PDF в разы быстрее pypdf.
+    Необязательная зависимость: если не установлена, возвращает None и PDF читает pypdf.
+    """
+    try:
+        import pymupdf
+        pymupdf.TOOLS.mupdf_display_errors(False)
+        return pymupdf
+    except ImportError:
+        return None
+
 class TextProcessor:
     @staticmethod
-    def read_file(file_path: Path) -> str:
+    def iter_pages(file_path: Path) -> Iterator[str]:
+        """
+        Постраничный (для DOCX - поабзацный, для больших текстовых файлов - блоками) текст документа.
+        Страницы отдаются по одной, без накопления всего текста в одной строке.
+        """
         ext = file_path.suffix.lower()
-        try:
-            if ext in [".txt", ".md", ".py", ".json", ".xml", ".html", ".java", ".kt", ".cpp"]:
-                return file_path.read_text(encoding="utf-8", errors='replace')
-
-            elif ext == ".pdf":
-                text = ""
-                with open(file_path, "rb") as f:
-                    reader = pypdf.PdfReader(f)
-                    for page in reader.pages:
-                        extracted = page.extract_text()
-                        if extracted: text += extracted + "\n"
-                return text
-
-            elif ext == ".docx":
-                doc = Document(file_path)
-                return "\n".join([para.text for para in doc.paragraphs])
+        if ext in TEXT_EXTS:
+            if file_path.stat().st_size < MMAP_TEXT_MIN:
+                yield file_path.read_text(encoding="utf-8", errors='replace')
+                return
+            # Байты берутся из страничного кэша ОС, копии всего файла в памяти процесса нет.
+            # Инкрементальный декодер склеивает символы UTF-8 и \r\n на границах блоков
+            decoder = io.IncrementalNewlineDecoder(
+                codecs.getincrementaldecoder("utf-8")(errors='replace'), translate=True
+            )
+            with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for pos in range(0, len(mm), TEXT_BLOCK):
+                    text = decoder.decode(mm[pos:pos + TEXT_BLOCK])
+                    if text: yield text
+            tail = decoder.decode(b"", final=True)
+            if tail: yield tail
+
+        elif ext == ".pdf":
+            pymupdf = get_pymupdf()
+            doc = None
+            if pymupdf:
+                try:
+                    doc = pymupdf.open(file_path)
+                except Exception:
+                    doc = None  # MuPDF не открыл файл - пробуем pypdf
+            if doc is not None and not doc.needs_pass:
+                with doc:
+                    for page in doc:
+                        extracted = page.get_text()
+                        if extracted: yield extracted
+                return
+            if doc is not None: doc.close()
+
+            with open(file_path, "rb") as f:
+                reader = pypdf.PdfReader(f)
+                for page in reader.pages:
+                    extracted = page.extract_text()
+                    if extracted: yield extracted
+
+        elif ext == ".docx":
+            # Потоковый разбор word/document.xml без объектной модели python-docx:
+            # каждый абзац отдаётся сразу и удаляется из дерева
+            with zipfile.ZipFile(file_path) as z, z.open("word/document.xml") as f:
+                for _, el in etree.iterparse(f, events=("end",), tag=_W + "p"):
+                    parts = []
+                    for node in el.iter(*DOCX_TEXT_TAGS):
+                        text = DOCX_TEXT_TAGS[node.tag]
+                        parts.append(node.text or "" if text is None else text)
+                    yield "".join(parts)
+                    el.clear()
+                    while el.getprevious() is not None:
+                        del el.getparent()[0]
 
-            else:
-                return ""
-        except Exception as e:
-            print(f"{Fore.RED}[READ ERROR] Файл {file_path.name}: {e}")
-            return ""
+    @staticmethod
+    def iter_text(file_path: Path) -> Iterator[str]:
+        """Текст документа кусками; страницы PDF и абзацы DOCX разделяются переводом строки."""
+        sep = "" if file_path.suffix.lower() in TEXT_EXTS else "\n"
+        for i, page in enumerate(TextProcessor.iter_pages(file_path)):
+            if i and sep: yield sep
+            yield page
+
+    @staticmethod
+    def split_stream(parts: Iterable[str], chunk_size: int, overlap: int, max_tokens: int = 0) -> List[str]:
+        """
+        Нарезка текста, поступающего кусками (iter_text). Режется окно не меньше TEXT_BLOCK,
+        недорезанный хвост переносится в следующее окно - весь текст целиком в памяти
+        не держится. Границы фрагментов не зависят от того, как текст разбит на куски.
+        """
+        chunks: List[str] = []
+        pending: List[str] = []
+        size = 0
+        for part in parts:
+            pending.append(part)
+            size += len(part)
+            if size >= TEXT_BLOCK:
+                window = "".join(pending)
+                rest = window[TextProcessor._split_into(chunks, window, chunk_size, overlap, max_tokens, final=False):]
+                pending, size = [rest], len(rest)
+        TextProcessor._split_into(chunks, "".join(pending), chunk_size, overlap, max_tokens)
+        return chunks
 
     @staticmethod
-    def recursive_split(text: str, chunk_size: int, overlap: int) -> List[str]:
-        if not text: return []
-        separators = ["\n\n", "\n", ". ", " ", ""]
-        chunks = []
+    def _split_into(chunks: List[str], text: str, chunk_size: int, overlap: int,
+                    max_tokens: int = 0, final: bool = True) -> int:
+        """
+        Режет text, дописывая фрагменты в chunks. При final=False останавливается там,
+        где следующему фрагменту может не хватить текста окна, и возвращает эту позицию.
+        """
+        if not text: return 0
         start = 0
         text_len = len(text)
 
+        tokenizer = get_tokenizer() if max_tokens > 0 else None
+
         while start < text_len:
+            if not final and start + chunk_size >= text_len:
+                return start
+            chunk_start = start
             end = start + chunk_size
+            if tokenizer is not None:
+                # Кодируем только окно кандидата, а не весь документ; если оно не влезает
+                # в лимит - конец окна там, где кончаются первые max_tokens токенов
+                # (недописанный последний символ UTF-8 отбрасывается)
+                tokens = tokenizer.encode(text[start:end], disallowed_special=())
+                if len(tokens) > max_tokens:
+                    head = tokenizer.decode_bytes(tokens[:max_tokens]).decode("utf-8", errors="ignore")
+                    end = max(start + 1, start + len(head))
+
             if end >= text_len:
                 chunk = text[start:].strip()
                 if chunk: chunks.append(chunk)
@@ -98,38 +252,136 @@ class TextProcessor:
 
             best_split = -1
             search_start = max(start, end - overlap)
-            search_area = text[search_start:end]
 
-            for sep in separators:
+            # rfind с границами ищет прямо в text - без копирования окна в новую строку
+            for sep in SEPARATORS:
                 if sep == "":
                     best_split = end
                     break
-                idx = search_area.rfind(sep)
+                idx = text.rfind(sep, search_start, end)
                 if idx != -1:
-                    best_split = search_start + idx + len(sep)
+                    best_split = idx + len(sep)
                     break
 
             chunk = text[start:best_split].strip()
             if chunk: chunks.append(chunk)
 
             start = best_split
-            if start <= (end - chunk_size): start = end - overlap
+            if start <= chunk_start: start = end - overlap
 
-        return chunks
+        return text_len
 
     @staticmethod
     def get_file_hash(file_path: Path) -> str:
-        hasher = hashlib.md5()
+        # Хэш нужен только для обнаружения изменений, криптостойкость не важна:
+        # xxh3 на порядок быстрее md5
+        hasher = xxhash.xxh3_64()
         try:
             with open(file_path, 'rb') as f:
-                buf = f.read(65536)
-                while len(buf) > 0:
-                    hasher.update(buf)
-                    buf = f.read(65536)
+                try:
+                    # Файл целиком отображается в память и хэшируется за один вызов.
+                    # Пустые/специальные файлы mmap не умеет, очень большие - читаем блоками
+                    if os.fstat(f.fileno()).st_size > MMAP_HASH_LIMIT: raise ValueError
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        hasher.update(mm)
+                except (ValueError, OSError):
+                    for buf in iter(lambda: f.read(1 << 20), b''):
+                        hasher.update(buf)
             return hasher.hexdigest()
         except Exception:
             return "error_hash"
 
+def process_file(file_path: Path, chunk_size: int, overlap: int,
+                 max_tokens: int = 0) -> Tuple[str, List[str]]:
+    """
+    Чтение и нарезка одного файла. Вынесено на уровень модуля,
+    чтобы функцию можно было отдать в ProcessPoolExecutor.
+    Ошибки чтения не печатаются в процессе пула (там не видно полосы tqdm),
+    а возвращаются исключением и выводятся основным процессом.
+    """
+    chunks = TextProcessor.split_stream(TextProcessor.iter_text(file_path), chunk_size, overlap, max_tokens)
+    return file_path.name, chunks
+
+@dataclass
+class ChunkBatch:
+    """Пакет фрагментов в виде параллельных списков - срезы вместо обхода списка словарей."""
+    ids: List[str] = field(default_factory=list)
+    texts: List[str] = field(default_factory=list)
+    embed_texts: List[str] = field(default_factory=list)
+    metadatas: List[Dict[str, Any]] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def extend(self, other: "ChunkBatch"):
+        self.ids.extend(other.ids)
+        self.texts.extend(other.texts)
+        self.embed_texts.extend(other.embed_texts)
+        self.metadatas.extend(other.metadatas)
+
+# --- КЭШ ЭМБЕДДИНГОВ ---
+
+class EmbeddingCache:
+    """
+    LRU-кэш векторов по хэшу текста фрагмента (и имени модели).
+    Повторяющиеся фрагменты (лицензии, импорты, подписи) не отправляются в LM Studio повторно.
+    Векторы годны только для модели, которая их посчитала: кэш привязан к подписи
+    (модель, отвечающая на сервере, и размерность) и работает лишь после bind().
+    """
+    def __init__(self, path: Path, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.data: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self.signature: Optional[Tuple[str, int]] = None
+        self.enabled = False
+        self.dirty = False
+        if max_size > 0:
+            try:
+                # Файл старого формата (без подписи) не читаем - такие векторы не с чем сверить
+                self.signature, self.data = pickle.loads(path.read_bytes())
+            except Exception:
+                pass
+
+    def bind(self, signature: Optional[Tuple[str, int]]):
+        """Включает кэш для модели signature; векторы другой модели выбрасываются. None - кэш выключен."""
+        self.enabled = signature is not None and self.max_size > 0
+        if not self.enabled or signature == self.signature: return
+        if self.data: self.clear()
+        self.signature = signature
+        self.dirty = True
+
+    def clear(self):
+        self.data.clear()
+        self.dirty = True
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        return xxhash.xxh3_64(f"{config.EMBEDDING_MODEL}\0{text}".encode("utf-8")).digest()
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        if not self.enabled: return None
+        vec = self.data.get(key)
+        if vec is not None: self.data.move_to_end(key)
+        return vec
+
+    def put(self, key: bytes, vec: np.ndarray):
+        if not self.enabled: return
+        self.data[key] = vec
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty: return
+        tmp_path = self.path.with_suffix(".tmp")
+        try:
+            tmp_path.write_bytes(pickle.dumps((self.signature, self.data), protocol=pickle.HIGHEST_PROTOCOL))
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except Exception as e:
+            print(f"{Fore.RED}[ERROR] Не удалось сохранить кэш эмбеддингов: {e}")
+
 # --- МЕНЕДЖЕР БАЗЫ ДАННЫХ ---
 
 class VectorDBManager:
@@ -147,9 +399,32 @@ class VectorDBManager:
         self.collection_name = "main_collection"
         self._refresh_collection_obj()
 
+        # Кэш состояния файлов: {коллекция: {файл: [mtime, size, hash]}}
+        self.state_path = config.CHROMA_PATH / ".rag_cache.bin"
+        self.file_state = self._load_file_state()
+        self.emb_cache = EmbeddingCache(config.CHROMA_PATH / ".emb_cache.bin", config.EMBED_CACHE_SIZE)
+
     def _refresh_collection_obj(self):
         self.collection = self.client.get_or_create_collection(name=self.collection_name)
 
+    def _load_file_state(self) -> Dict[str, Dict[str, list]]:
+        try:
+            return pickle.loads(self.state_path.read_bytes())
+        except Exception:
+            return {}
+
+    def _save_file_state(self):
+        tmp_path = self.state_path.with_suffix(".tmp")
+        try:
+            tmp_path.write_bytes(pickle.dumps(self.file_state, protocol=pickle.HIGHEST_PROTOCOL))
+            os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            print(f"{Fore.RED}[ERROR] Не удалось сохранить кэш файлов: {e}")
+
+    def _forget_file_state(self, collection_name: str):
+        if self.file_state.pop(collection_name, None) is not None:
+            self._save_file_state()
+
     def check_lm_studio(self) -> bool:
         try:
             self.openai_client.models.list()
@@ -169,6 +444,10 @@ class VectorDBManager:
     def truncate_collection(self):
         try:
             self.client.delete_collection(self.collection_name)
+            self._forget_file_state(self.collection_name)
+            # Очистку делают и при смене модели эмбеддингов - старые векторы из кэша не годятся
+            self.emb_cache.clear()
+            self.emb_cache.save()
             self._refresh_collection_obj()
             print(f"{Fore.YELLOW}[WARN] Коллекция '{self.collection_name}' очищена.")
         except Exception as e:
@@ -181,34 +460,343 @@ class VectorDBManager:
             return
         try:
             self.client.delete_collection(target)
+            self._forget_file_state(target)
             print(f"{Fore.YELLOW}[WARN] Коллекция '{target}' удалена.")
             self.set_collection("main_collection")
         except Exception as e:
             print(f"{Fore.RED}[ERROR] Ошибка удаления: {e}")
 
-    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
-        cleaned_texts = [t.replace("\n", " ") for t in texts]
+    async def _embed_batch(self, client: AsyncOpenAI, texts: List[str]) -> np.ndarray:
+        resp = await client.embeddings.create(
+            input=texts, model=config.EMBEDDING_MODEL
+        )
+        data = sorted(resp.data, key=lambda x: x.index)
+        if len(data) != len(texts):
+            raise ValueError(f"LM Studio вернул {len(data)} векторов на {len(texts)} текстов")
+        return np.asarray([item.embedding for item in data], dtype=np.float32)
+
+    async def _bind_emb_cache(self, client: AsyncOpenAI):
+        """Сверяет кэш эмбеддингов с моделью, которую реально отдаёт LM Studio (один короткий запрос)."""
+        if self.emb_cache.max_size <= 0: return
         try:
-            resp = self.openai_client.embeddings.create(
-                input=cleaned_texts, model=config.EMBEDDING_MODEL
-            )
-            data = sorted(resp.data, key=lambda x: x.index)
-            return [item.embedding for item in data]
+            resp = await client.embeddings.create(input=["ping"], model=config.EMBEDDING_MODEL)
+            self.emb_cache.bind((resp.model, len(resp.data[0].embedding)))
+        except Exception:
+            # Модель не опознать - в этот запуск кэш не используется
+            self.emb_cache.bind(None)
+
+    async def _embed_isolated(self, client: AsyncOpenAI, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Векторы texts; None - для текстов без вектора. Если LM Studio отклонил пакет
+        (REJECT_STATUSES), пакет делится пополам, пока отказ не сузится до конкретных
+        текстов. Прочие сбои (связь, 5xx после повторов клиента) оставляют без векторов весь пакет.
+        """
+        try:
+            return list(await self._embed_batch(client, texts))
+        except APIStatusError as e:
+            if e.status_code in REJECT_STATUSES and len(texts) > 1:
+                mid = len(texts) // 2
+                return (await self._embed_isolated(client, texts[:mid])
+                        + await self._embed_isolated(client, texts[mid:]))
+            tqdm.write(f"{Fore.RED}[API ERROR] Ошибка LM Studio: {e}")
         except Exception as e:
-            print(f"{Fore.RED}[API ERROR] Ошибка LM Studio: {e}")
-            raise e
+            tqdm.write(f"{Fore.RED}[API ERROR] Ошибка LM Studio: {e}")
+        return [None] * len(texts)
 
-    def file_needs_update(self, filename: str, current_hash: str) -> bool:
+    async def _embed_cached(self, client: AsyncOpenAI, texts: List[str],
+                            inflight: Dict[bytes, asyncio.Future]) -> Tuple[Optional[np.ndarray], List[int], int]:
+        """
+        Векторы пакета texts (уже без переводов строк) в порядке texts. Попадания берутся
+        из кэша; одинаковые тексты, в том числе уже запрошенные другим пакетом (inflight),
+        уходят в LM Studio один раз. Возвращает массив (строки без вектора заполнены нулями;
+        None, если векторов нет ни для одного текста), номера строк без вектора
+        и число текстов, отправленных в LM Studio.
+        """
+        vectors: List[Optional[np.ndarray]] = [None] * len(texts)
+        own: Dict[bytes, List[int]] = {}
+        foreign: Dict[bytes, Tuple[asyncio.Future, List[int]]] = {}
+
+        for row, text in enumerate(texts):
+            key = EmbeddingCache.key(text)
+            vec = self.emb_cache.get(key)
+            if vec is not None:
+                vectors[row] = vec
+            elif key in own:
+                own[key].append(row)
+            elif key in inflight:
+                foreign.setdefault(key, (inflight[key], []))[1].append(row)
+            else:
+                own[key] = [row]
+                inflight[key] = asyncio.get_running_loop().create_future()
+
+        if own:
+            keys = list(own)
+            result = await self._embed_isolated(client, [texts[own[k][0]] for k in keys])
+            # Свои запросы завершаем до ожидания чужих - взаимной блокировки пакетов не будет
+            for n, key in enumerate(keys):
+                vec = None if result[n] is None else result[n].copy()
+                if vec is not None: self.emb_cache.put(key, vec)
+                for row in own[key]: vectors[row] = vec
+                inflight.pop(key).set_result(vec)
+
+        for fut, rows in foreign.values():
+            vec = await fut
+            for row in rows: vectors[row] = vec
+
+        failed = [row for row, vec in enumerate(vectors) if vec is None]
+        if len(failed) == len(vectors):
+            return None, failed, len(own)
+        if failed:
+            # Строки без вектора всё равно не попадут в БД: их файлы помечаются сбойными
+            blank = np.zeros_like(next(vec for vec in vectors if vec is not None))
+            for row in failed: vectors[row] = blank
+        return np.stack(vectors), failed, len(own)
+
+    async def _ingest_pipeline(self, changed: Dict[str, Tuple[Path, list]]) -> Tuple[List[str], set, int, int]:
+        """
+        Конвейер индексации: чтение и нарезка (пул процессов) -> векторизация
+        (EMBED_CONCURRENCY параллельных запросов) -> запись в ChromaDB.
+        Стадии связаны ограниченными очередями: следующие файлы читаются, пока
+        векторизуются предыдущие, а память не растёт с размером папки.
+        Возвращает прочитанные файлы (в том числе без текста), файлы со сбоями, число фрагментов
+        и число текстов, отправленных в LM Studio.
+        """
+        loop = asyncio.get_running_loop()
+        n_embedders = config.EMBED_CONCURRENCY
+        batches: asyncio.Queue = asyncio.Queue(maxsize=2 * n_embedders)
+        embedded: asyncio.Queue = asyncio.Queue(maxsize=2 * n_embedders)
+        inflight: Dict[bytes, asyncio.Future] = {}
+        done_files: List[str] = []
+        failed_sources: set = set()
+        # Сколько фрагментов у файла после нарезки и сколько из них уже записано в БД
+        expected: Dict[str, int] = {}
+        written: Counter = Counter()
+        stats = {"chunks": 0, "requested": 0}
+
+        # Доступность токенизатора проверяем здесь, один раз за сессию:
+        # иначе каждый процесс пула заново пытался бы скачать словарь
+        max_tokens = config.CHUNK_MAX_TOKENS if config.CHUNK_MAX_TOKENS and get_tokenizer() else 0
+        split_file = partial(process_file, chunk_size=config.CHUNK_SIZE,
+                             overlap=config.CHUNK_OVERLAP, max_tokens=max_tokens)
+
+        # Пишем крупными пакетами: меньше транзакций и перестроек индекса на стороне Chroma
+        write_batch = config.DB_WRITE_BATCH
         try:
-            res = self.collection.get(where={"source": filename}, include=["metadatas"], limit=1)
-            if not res['metadatas']: return True
-            return res['metadatas'][0].get("file_hash", "") != current_hash
-        except Exception:
-            return True
+            write_batch = min(write_batch, self.client.get_max_batch_size())
+        except Exception: pass
+
+        async def produce(workers: int):
+            batch = ChunkBatch()
+            tokens = 0
+            pool = ProcessPoolExecutor(max_workers=workers)
+            # Файлы, бывшие в работе, когда процесс пула аварийно завершился
+            suspects: List[str] = []
+
+            async def emit(name: str, chunks: List[str]):
+                nonlocal batch, tokens
+                tqdm.write(f"{Fore.YELLOW}[READ] {name}...")
+                expected[name] = len(chunks)
+                # Прочитанный файл без текста (пустой, скан PDF) тоже запоминаем в кэше состояния,
+                # иначе каждый запуск заново хэшировал бы его и перечитывал метаданные коллекции
+                done_files.append(name)
+                if not chunks: return
+                f_hash = changed[name][1][2]
+
+                for i, chunk_text in enumerate(chunks):
+                    # Для модели переводы строк заменяем пробелами сразу, один раз;
+                    # в БД сохраняется исходный текст
+                    embed_text = chunk_text.replace("\n", " ")
+                    # Жадная упаковка: пакет закрывается по BATCH_SIZE текстов
+                    # или по бюджету EMBED_MAX_TOKENS (оценка ~4 символа на токен)
+                    cost = len(embed_text) // 4 + 1
+                    if batch and (len(batch) >= config.BATCH_SIZE or tokens + cost > config.EMBED_MAX_TOKENS):
+                        await batches.put(batch)
+                        batch, tokens = ChunkBatch(), 0
+                    batch.ids.append(f"{name}_{i}")
+                    batch.texts.append(chunk_text)
+                    batch.embed_texts.append(embed_text)
+                    batch.metadatas.append({
+                        "source": name,
+                        "file_hash": f_hash,
+                        "chunk_index": i
+                    })
+                    tokens += cost
+
+            def submit(name: str):
+                nonlocal pool
+                try:
+                    fut = loop.run_in_executor(pool, split_file, changed[name][0])
+                except BrokenProcessPool:
+                    pool.shutdown(wait=False)
+                    pool = ProcessPoolExecutor(max_workers=workers)
+                    fut = loop.run_in_executor(pool, split_file, changed[name][0])
+                return name, pool, fut
+
+            async def collect(name: str, fut_pool: ProcessPoolExecutor, fut: asyncio.Future):
+                nonlocal pool
+                try:
+                    _, chunks = await fut
+                except BrokenProcessPool:
+                    # Упавший процесс ломает весь пул, и по ошибке не понять, какой файл виноват:
+                    # остальные файлы идут в новый пул, а бывшие в работе проверяются поодиночке
+                    if fut_pool is pool:
+                        pool.shutdown(wait=False)
+                        pool = ProcessPoolExecutor(max_workers=workers)
+                    suspects.append(name)
+                    return
+                except Exception as e:
+                    tqdm.write(f"{Fore.RED}[READ ERROR] Файл {name}: {e}")
+                    failed_sources.add(name)
+                    return
+                await emit(name, chunks)
+
+            try:
+                # В работе не больше 2 файлов на процесс - остальные ждут своей очереди
+                pending = deque()
+                for name in changed:
+                    pending.append(submit(name))
+                    if len(pending) >= 2 * workers:
+                        await collect(*pending.popleft())
+                while pending:
+                    await collect(*pending.popleft())
+
+                solo: Optional[ProcessPoolExecutor] = None
+                for name in suspects:
+                    if solo is None: solo = ProcessPoolExecutor(max_workers=1)
+                    try:
+                        _, chunks = await loop.run_in_executor(solo, split_file, changed[name][0])
+                    except Exception as e:
+                        if isinstance(e, BrokenProcessPool):
+                            solo.shutdown(wait=False)
+                            solo = None
+                            e = "процесс обработки аварийно завершился"
+                        tqdm.write(f"{Fore.RED}[READ ERROR] Файл {name}: {e}")
+                        failed_sources.add(name)
+                        continue
+                    await emit(name, chunks)
+                if solo is not None: solo.shutdown()
+
+                if batch: await batches.put(batch)
+                # Маркеры конца - только при нормальном завершении: при аварии задачи отменяются,
+                # и ожидание места в очереди, которую уже некому разбирать, повесило бы конвейер
+                for _ in range(n_embedders):
+                    await batches.put(None)
+            finally:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+        async def embed(client: AsyncOpenAI):
+            while (batch := await batches.get()) is not None:
+                vectors, failed_rows, requested = await self._embed_cached(client, batch.embed_texts, inflight)
+                stats["requested"] += requested
+                await embedded.put((batch, vectors, failed_rows))
+            await embedded.put(None)
+
+        async def write_rows(rows: ChunkBatch, vectors: List[np.ndarray]):
+            emb = np.concatenate(vectors)
+            # Файлы, для части фрагментов которых нет векторов, не пишем вовсе
+            if any(m["source"] in failed_sources for m in rows.metadatas):
+                keep = [r for r, m in enumerate(rows.metadatas) if m["source"] not in failed_sources]
+                rows = ChunkBatch(
+                    ids=[rows.ids[r] for r in keep],
+                    texts=[rows.texts[r] for r in keep],
+                    metadatas=[rows.metadatas[r] for r in keep],
+                )
+                emb = emb[keep]
+
+            for i in range(0, len(rows), write_batch):
+                j = i + write_batch
+                try:
+                    # upsert: повторный запуск после сбоя перезапишет фрагменты, а не упадёт на дублях id
+                    await loop.run_in_executor(db_writer, partial(
+                        self.collection.upsert,
+                        ids=rows.ids[i:j],
+                        embeddings=emb[i:j],
+                        documents=rows.texts[i:j],
+                        metadatas=rows.metadatas[i:j]
+                    ))
+                    written.update(m["source"] for m in rows.metadatas[i:j])
+                except Exception as e:
+                    tqdm.write(f"{Fore.RED}[ERROR] Сбой записи пакета: {e}")
+                    failed_sources.update(m["source"] for m in rows.metadatas[i:j])
+
+        async def write(pbar: tqdm):
+            rows = ChunkBatch()
+            vectors: List[np.ndarray] = []
+            finished = 0
+            while finished < n_embedders:
+                item = await embedded.get()
+                if item is None:
+                    finished += 1
+                    continue
+                batch, batch_vectors, failed_rows = item
+                stats["chunks"] += len(batch)
+                pbar.update(len(batch))
+                # Сбойными считаются только файлы тех фрагментов, что остались без вектора
+                failed_sources.update(batch.metadatas[row]["source"] for row in failed_rows)
+                if batch_vectors is None: continue
+                rows.extend(batch)
+                vectors.append(batch_vectors)
+                if len(rows) >= write_batch:
+                    await write_rows(rows, vectors)
+                    rows, vectors = ChunkBatch(), []
+            if rows:
+                await write_rows(rows, vectors)
+
+        workers = min(os.cpu_count() or 1, len(changed))
+        # На Windows ProcessPoolExecutor не принимает больше 61 процесса
+        if sys.platform == "win32": workers = min(workers, 61)
+        # Запись в Chroma - в одном отдельном потоке: при аварии можно дождаться
+        # начатого upsert и только потом убрать недописанные файлы
+        db_writer = ThreadPoolExecutor(max_workers=1)
+        tasks: List[asyncio.Future] = []
+        try:
+            # Клиент создаём внутри цикла событий: пул соединений httpx привязан к loop,
+            # а asyncio.run() каждый раз поднимает новый
+            async with AsyncOpenAI(base_url=config.LM_STUDIO_URL, api_key=config.API_KEY,
+                                   max_retries=config.EMBED_RETRIES) as client:
+                await self._bind_emb_cache(client)
+                with tqdm(desc="Загрузка", unit=" фрагм.", mininterval=0.5) as pbar:
+                    tasks = [
+                        asyncio.ensure_future(produce(workers)),
+                        *[asyncio.ensure_future(embed(client)) for _ in range(n_embedders)],
+                        asyncio.ensure_future(write(pbar)),
+                    ]
+                    await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks: task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            db_writer.shutdown(wait=True)
+            # Файл, записанный не целиком, сохранил бы новый file_hash и навсегда
+            # выпал бы из повторной индексации - убираем его фрагменты
+            self.clean_file_chunks([name for name in changed if written[name] != expected.get(name)])
+            raise
+        db_writer.shutdown()
+
+        return done_files, failed_sources, stats["chunks"], stats["requested"]
+
+    def get_stored_hashes(self, page_size: int = 5000) -> Dict[str, str]:
+        """
+        Хэши всех проиндексированных файлов коллекции {source: file_hash}.
+        Одна постраничная выборка метаданных вместо запроса на каждый файл.
+        """
+        stored: Dict[str, str] = {}
+        offset = 0
+        try:
+            while True:
+                res = self.collection.get(include=["metadatas"], limit=page_size, offset=offset)
+                metas = res['metadatas']
+                for m in metas:
+                    stored.setdefault(m.get("source", ""), m.get("file_hash", ""))
+                if len(metas) < page_size: break
+                offset += page_size
+        except Exception as e:
+            print(f"{Fore.RED}[ERROR] Не удалось прочитать метаданные коллекции: {e}")
+        return stored
 
-    def clean_file_chunks(self, filename: str):
+    def clean_file_chunks(self, filenames: List[str]):
+        if not filenames: return
         try:
-            self.collection.delete(where={"source": filename})
+            self.collection.delete(where={"source": {"$in": filenames}})
         except Exception: pass
 
     # --- НОВАЯ ЛОГИКА ВЫБОРА ФАЙЛОВ ---
@@ -287,7 +875,9 @@ class VectorDBManager:
             return
 
         # 1. Сортируем файлы, чтобы порядок был всегда одинаковым (для выбора по номерам)
-        all_files = sorted([f for f in folder_path.iterdir() if f.is_file()])
+        # scandir: тип файла берётся из записи каталога, без отдельного stat на каждый файл
+        with os.scandir(folder_path) as it:
+            all_files = sorted(Path(e.path) for e in it if e.is_file())
 
         if not all_files:
             print(f"{Fore.YELLOW}Папка пуста.")
@@ -301,59 +891,91 @@ class VectorDBManager:
 
         print(f"{Fore.CYAN}Запуск анализа {len(target_files)} файлов...")
 
-        batch_docs = []
         files_processed = 0
 
-        # 3. Обработка выбранных файлов
+        known = self.file_state.setdefault(self.collection_name, {})
+        pending_state: Dict[str, list] = {}
+
+        # 3. Отбор изменившихся файлов (дешёвые проверки - в основном потоке)
+        changed: Dict[str, Tuple[Path, list]] = {}
+        stored: Optional[Dict[str, str]] = None
         for file_path in target_files:
-            f_hash = TextProcessor.get_file_hash(file_path)
+            # Проверка в три ступени: запись в кэше -> mtime/размер -> хэш содержимого
+            if file_path.suffix.lower() not in SUPPORTED_EXTS:
+                print(f"{Fore.GREEN}[SKIP] {file_path.name} (формат не поддерживается)")
+                continue
 
-            if not self.file_needs_update(file_path.name, f_hash):
+            # Файл мог исчезнуть, пока пользователь выбирал (например, временный ~$x.docx)
+            try:
+                st = file_path.stat()
+            except OSError as e:
+                print(f"{Fore.RED}[READ ERROR] Файл {file_path.name}: {e}")
+                continue
+            prev = known.get(file_path.name)
+            # mtime и размер не изменились с прошлой индексации - файл даже не читаем
+            if prev and prev[0] == st.st_mtime and prev[1] == st.st_size:
                 print(f"{Fore.GREEN}[SKIP] {file_path.name}")
                 continue
 
-            print(f"{Fore.YELLOW}[READ] {file_path.name}...")
-            self.clean_file_chunks(file_path.name)
+            f_hash = TextProcessor.get_file_hash(file_path)
+            if f_hash == "error_hash":
+                print(f"{Fore.RED}[READ ERROR] Файл {file_path.name}: не удалось прочитать")
+                continue
 
-            text = TextProcessor.read_file(file_path)
-            if not text: continue
+            # Файл "тронут", но содержимое прежнее - достаточно обновить mtime в кэше
+            if prev and prev[2] == f_hash:
+                print(f"{Fore.GREEN}[SKIP] {file_path.name}")
+                known[file_path.name] = [st.st_mtime, st.st_size, f_hash]
+                continue
 
-            chunks = TextProcessor.recursive_split(text, config.CHUNK_SIZE, config.CHUNK_OVERLAP)
+            # Метаданные коллекции читаем один раз и только если до них дошло дело
+            if stored is None: stored = self.get_stored_hashes()
 
-            for i, chunk_text in enumerate(chunks):
-                chunk_id = f"{file_path.name}_{i}"
-                batch_docs.append({
-                    "id": chunk_id,
-                    "text": chunk_text,
-                    "metadata": {
-                        "source": file_path.name,
-                        "file_hash": f_hash,
-                        "chunk_index": i
-                    }
-                })
-            files_processed += 1
+            if stored.get(file_path.name) == f_hash:
+                print(f"{Fore.GREEN}[SKIP] {file_path.name}")
+                known[file_path.name] = [st.st_mtime, st.st_size, f_hash]
+                continue
 
-        # 4. Загрузка в БД
-        total_chunks = len(batch_docs)
-        if total_chunks > 0:
-            print(f"{Fore.CYAN}[EMBED] Векторизация {total_chunks} фрагментов...")
+            changed[file_path.name] = (file_path, [st.st_mtime, st.st_size, f_hash])
 
-            for i in tqdm(range(0, total_chunks, config.BATCH_SIZE), desc="Загрузка"):
-                batch = batch_docs[i : i + config.BATCH_SIZE]
-                try:
-                    self.collection.add(
-                        ids=[d["id"] for d in batch],
-                        embeddings=self.get_embeddings([d["text"] for d in batch]),
-                        documents=[d["text"] for d in batch],
-                        metadatas=[d["metadata"] for d in batch]
-                    )
-                except Exception:
-                    print(f"{Fore.RED}[ERROR] Сбой на пакете {i}")
+        # Старые фрагменты изменившихся файлов - одним удалением. Вместе с ними забываем
+        # и состояние файла: иначе после сбоя и отката правки хэш совпал бы с прежним,
+        # и файл без единого фрагмента в базе пропускался бы вечно
+        self.clean_file_chunks(list(changed))
+        for name in changed: known.pop(name, None)
+
+        # 4. Конвейер: чтение и нарезка -> векторизация -> запись в БД
+        total_chunks = 0
+        if changed:
+            print(f"{Fore.CYAN}[EMBED] Векторизация изменившихся файлов: {len(changed)}")
+            try:
+                done_files, failed_sources, total_chunks, requested = asyncio.run(self._ingest_pipeline(changed))
+            finally:
+                # Даже при аварии сохраняем уже полученные векторы и обновлённые mtime
+                self.emb_cache.save()
+                self._save_file_state()
+
+            if total_chunks > requested:
+                print(f"{Fore.CYAN}[CACHE] Без запроса к LM Studio (кэш и повторы): {total_chunks - requested} из {total_chunks}")
+
+            # Файлы, записанные не полностью, убираем целиком - следующий запуск проиндексирует их заново
+            if failed_sources:
+                print(f"{Fore.YELLOW}[WARN] Не проиндексированы (см. ошибки выше), "
+                      f"будут обработаны при следующем запуске: {', '.join(sorted(failed_sources))}")
+            self.clean_file_chunks(sorted(failed_sources))
+            for name in done_files:
+                if name not in failed_sources:
+                    pending_state[name] = changed[name][1]
+            files_processed = len(pending_state)
 
+        if total_chunks > 0:
             print(f"{Fore.GREEN}[DONE] Обновлено файлов: {files_processed}")
         else:
             print("Нет новых данных для записи (все файлы актуальны).")
 
+        known.update(pending_state)
+        self._save_file_state()
+
 # --- UI ---
 
 def manage_collections_menu(db: VectorDBManager):